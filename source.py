@@ -8,8 +8,24 @@ import pandas as pd
 import numpy as np
 import scipy as sp
 from scipy import stats
+from scipy import spatial
 import math
 import statistics as st
+import hashlib
+import os
+import pickle
+import tempfile
+import glob
+import multiprocessing
+import sqlite3
+import asyncio
+import json
+import socket
+import sys
+import io
+import queue
+import threading
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 
 # --- SETUP ------------------------------
@@ -18,7 +34,7 @@ run through nearly 50 million data points each time, it was decided that a sampl
 of the dataset was to be used, while making sure that it is still reflective enough
 of the overall datset. This also prevents overfitting, which would cause any
 conclusions or analysis to be too overly specific.'''
-def csv_redux(datafile):
+def csv_redux(datafile, keep_coords=False):
 
     '''Reads CSV file and converts contents into dataframe.'''
     data = pd.read_csv(datafile)
@@ -28,7 +44,14 @@ def csv_redux(datafile):
     not relevant to the purposes of this project. In addition, the stop times are
     not needed because the month and year of each trip is determined by the time at
     which they began.'''
-    data_cols = data[['tripduration', 'starttime', 'start station name', 'end station name', 'usertype', 'birth year', 'gender']]
+    cols = ['tripduration', 'starttime', 'start station name', 'end station name', 'usertype', 'birth year', 'gender']
+
+    '''For spatial analysis (see STATION INDEX below), the station coordinates can
+    optionally be kept. They are only needed to build the station table, so they are
+    left out by default to keep the master dataset small.'''
+    if keep_coords:
+        cols = cols + coord_cols
+    data_cols = data[cols]
 
     '''Removing all trips with a duration of at least five hours. Chances are the
     high duration of most of these trips are due to improper docking. For example,
@@ -60,27 +83,733 @@ def csv_redux(datafile):
     def gen_sample():
         piece = data_fil.sample(frac=0.20, axis=0)
         return piece
-        sample = gen_sample()
-        sam_td_mn = sample.tripduration.mean()
-        while sam_td_mn > 0:
-            if (sam_td_mn > lower_bound) & (sam_td_mn < upper_bound):
-                break
-            else:
-                sample = gen_sample()
+    sample = gen_sample()
+    sam_td_mn = sample.tripduration.mean()
+    while sam_td_mn > 0:
+        if (sam_td_mn > lower_bound) & (sam_td_mn < upper_bound):
+            break
+        else:
+            sample = gen_sample()
+            sam_td_mn = sample.tripduration.mean()
 
     '''When the sample is taken, the original indices are kept. In order to be able
     to properly index any given data set, the index is reset from 0 to the length of
     the sample.'''
     sample.reset_index(drop=True, inplace=True)
 
-    '''Extracting year and month from starttime column'''
-    for i in str(len(sample)):
-        sample['year'] = sample.starttime[int(i)][0:4]
-        sample['month'] = sample.starttime[int(i)][5:7]
+    '''Extracting year and month from starttime column (as numbers, since that is how
+    the program proper compares them)'''
+    sample['year'] = sample.starttime.str[0:4].astype(int)
+    sample['month'] = sample.starttime.str[5:7].astype(int)
     return sample
 
+def load_masterdata(data):
+    '''Loads a master dataset that was saved earlier (such as output/masterdata.csv),
+    or tidies one that is given as a dataframe. Since the samples in csv_redux are
+    random, reusing a saved master dataset is the only way to get the exact same
+    results (and the same cached results, see RESULT CACHE) from one run to the next.'''
+    md = pd.read_csv(data) if isinstance(data, str) else data
+    md = md[[c for c in md.columns if not c.startswith('Unnamed')]].copy()
+    md['year'] = pd.to_numeric(md['year']).astype(int)
+    md['month'] = pd.to_numeric(md['month']).astype(int)
+    return md
+
+# --- READ-AHEAD PIPELINE ------------------------------
+'''Reducing one data file means first reading it from disk, then parsing, filtering and
+sampling it, so the disk sits idle while a file is being reduced and the processor sits
+idle while a file is being read. Instead, the raw contents of the next file can be read
+on a background thread while the current one is being reduced. The reader only starts
+on a file once there is room for it, so at most read_depth files are read ahead of the
+one being reduced, and at most read_depth + 1 raw files are in memory at once, no
+matter how many files there are.'''
+read_depth = 1
+
+def read_ahead(datafiles, depth=None):
+    '''Reads the raw contents of each data file on a background thread, yielding them
+    in order. Unless another depth is given, read_depth is used.'''
+    if depth is None:
+        depth = read_depth
+    raw_files = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+
+    def reader():
+        for datafile in datafiles:
+            # Waits for room before reading, unless the files are no longer wanted
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            if stop.is_set():
+                return
+            try:
+                with open(datafile, 'rb') as f:
+                    item = (datafile, f.read(), None)
+            except Exception as e:
+                item = (datafile, None, e)
+            raw_files.put(item)
+            if item[2] is not None:
+                return
+        # The queue itself is not bounded (the slots are), so this never blocks
+        raw_files.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = raw_files.get()
+            if item is None:
+                break
+            slots.release()
+            datafile, raw, error = item
+            if error is not None:
+                raise error
+            yield datafile, raw
+    finally:
+        stop.set()
+
+def pipelined_redux(datafiles, depth=None, **kwargs):
+    '''Does the same as running csv_redux on each data file in turn, except that the
+    next file is read while the current one is reduced.'''
+    for datafile, raw in read_ahead(datafiles, depth):
+        yield csv_redux(io.BytesIO(raw), **kwargs)
+
+# --- STATION INDEX ------------------------------
+'''The start and end station coordinates are dropped by default, which means trips
+cannot be grouped by area. With keep_coords=True in csv_redux, the coordinates are
+kept so that a station table can be built from the master dataset. Each station only
+appears once in that table, so a KD-tree over it is small and quick to build, and
+every spatial lookup is done per station instead of per trip.'''
+coord_cols = ['start station latitude', 'start station longitude',
+              'end station latitude', 'end station longitude']
+
+# Kilometers per degree of latitude and of longitude (at the latitude of NYC)
+km_lat = 110.574
+km_lon = 111.320 * math.cos(math.radians(40.73))
+
+def station_xy(lat, lon):
+    '''Converts latitudes and longitudes into flat x-y coordinates in kilometers. Over
+    an area the size of NYC, the error of this approximation is negligible, and it lets
+    the KD-tree work with distances in kilometers.'''
+    return np.column_stack([np.asarray(lon, dtype=float) * km_lon,
+                            np.asarray(lat, dtype=float) * km_lat])
+
+def station_table(md):
+    '''Builds a deduplicated table of stations (name, latitude, longitude) from the
+    start and end stations of a master dataset that was reduced with keep_coords=True.'''
+    starts = md[['start station name', 'start station latitude', 'start station longitude']]
+    ends = md[['end station name', 'end station latitude', 'end station longitude']]
+    starts.columns = ends.columns = ['station name', 'latitude', 'longitude']
+    stations = pd.concat([starts, ends]).dropna().drop_duplicates('station name')
+    stations.reset_index(drop=True, inplace=True)
+    return stations
+
+def station_tree(stations):
+    '''Builds the KD-tree over the station table.'''
+    return spatial.cKDTree(station_xy(stations.latitude, stations.longitude))
+
+def stations_within(stations, tree, lat, lon, radius):
+    '''Returns all stations within the given radius (in km) of a point.'''
+    idx = tree.query_ball_point(station_xy([lat], [lon])[0], radius)
+    return stations.iloc[sorted(idx)]
+
+def nearest_stations(stations, tree, lat, lon, k=1):
+    '''Returns the k stations closest to a point, along with their distance (in km).
+    If there are fewer than k stations, all of them are returned.'''
+    dist, idx = tree.query(station_xy([lat], [lon])[0], k=k)
+    dist = np.atleast_1d(dist)
+    idx = np.atleast_1d(idx)
+    # Past the last station, the tree pads the results with an index of tree.n
+    found = idx < tree.n
+    near = stations.iloc[idx[found]].copy()
+    near['distance'] = dist[found]
+    return near
+
+def station_cells(stations, cell_size=1.0, neighborhoods=None):
+    '''Assigns every station to a cell. If a table of neighborhoods (name, latitude,
+    longitude) is given, each station is assigned to the neighborhood with the closest
+    center. Otherwise, each station is assigned to a square grid cell with sides of
+    cell_size kilometers. Either way, all stations are looked up at once.'''
+    xy = station_xy(stations.latitude, stations.longitude)
+    if neighborhoods is not None:
+        hood_tree = spatial.cKDTree(station_xy(neighborhoods.latitude, neighborhoods.longitude))
+        idx = hood_tree.query(xy)[1]
+        cells = np.asarray(neighborhoods['name'])[idx]
+    else:
+        grid = np.floor(xy / cell_size).astype(int)
+        cells = pd.Series(grid[:, 0]).astype(str) + ',' + pd.Series(grid[:, 1]).astype(str)
+    return pd.Series(np.asarray(cells), index=stations['station name'])
+
+def trips_by_cell(md, cells, station='start', by=None):
+    '''Given the cell of every station, the number of trips and average trip duration
+    are calculated for each cell. Trips are placed by their start station (or end
+    station, with station='end'), and can be further broken down by other columns, such
+    as by=['year', 'month']. As with the other figures, the number of trips is
+    multiplied by 5 to make up for the 20% sample.'''
+    trip_cells = md[station + ' station name'].map(cells).rename('cell')
+    keys = [trip_cells] + [md[col] for col in (by or [])]
+    cell_stats = md.groupby(keys)['tripduration'].agg(['size', 'mean'])
+    cell_stats.columns = ['trips', 'avg duration']
+    cell_stats['trips'] = 5 * cell_stats['trips']
+    return cell_stats
+
+# --- RESULT CACHE ------------------------------
+'''Every run of the program proper recalculates each monthly figure from the master
+dataset, even when nothing about the data has changed. The aggregation functions can
+instead be wrapped in a cache, so that each result is only calculated once for a given
+master dataset. Results are kept in memory (for repeated calls in the same run) and
+on disk (for later runs), and the oldest results are removed once either one is full.'''
+cache_dir = 'cache'
+cache_mem_items = 64
+cache_disk_bytes = 512 * 1024 ** 2
+mem_cache = OrderedDict()
+
+def md_fingerprint(md):
+    '''Creates a fingerprint of the master dataset from a hash of every row, so that
+    any change to the data (including to the sample that was taken) changes it.'''
+    row_hashes = pd.util.hash_pandas_object(md, index=False).values
+    fingerprint = hashlib.sha1(row_hashes.tobytes())
+    fingerprint.update(repr(list(md.columns)).encode())
+    return fingerprint.hexdigest()
+
+def code_fingerprint(code):
+    '''Describes a function's code: its bytecode, along with the constants (such as the
+    5 in 5 * len(...)) and names it uses, which are not part of the bytecode itself.
+    Nested functions are described the same way, since their repr would change from
+    one run to the next.'''
+    consts = []
+    for c in code.co_consts:
+        if hasattr(c, 'co_code'):
+            consts.append(code_fingerprint(c))
+        elif isinstance(c, frozenset):
+            # The order of a set changes from one run to the next, so it is sorted first
+            consts.append('frozenset(' + repr(sorted(repr(v) for v in c)) + ')')
+        else:
+            consts.append(repr(c))
+    return (code.co_code, tuple(consts), code.co_names)
+
+def value_fingerprint(value):
+    '''Describes an argument by its full contents. The repr of a large array or
+    dataframe leaves most of it out (with ...), so two different arguments could
+    otherwise share a cache key.'''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        contents = hashlib.sha1(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        return (type(value).__name__, repr(labels), repr(value.dtypes), contents.hexdigest())
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return ('ndarray', str(value.dtype), value.shape, hashlib.sha1(value.tobytes()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(value_fingerprint(v) for v in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((repr(k), value_fingerprint(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return (type(value).__name__,) + tuple(sorted(repr(value_fingerprint(v)) for v in value))
+    if value is None or isinstance(value, (str, bytes, bool, int, float, np.generic)):
+        return (type(value).__name__, repr(value))
+    # Anything else is described by its pickled contents
+    return (type(value).__name__, hashlib.sha1(pickle.dumps(value, protocol=4)).hexdigest())
+
+def cache_key(fingerprint, func, args, kwargs):
+    '''A result is identified by the dataset, the function (including its code, so that
+    editing a function does not return old results) and the arguments it was given.'''
+    key = repr((fingerprint, func.__qualname__, code_fingerprint(func.__code__),
+                value_fingerprint(args), value_fingerprint(kwargs)))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def evict_disk_cache():
+    '''Removes the least recently used results on disk until they fit within
+    cache_disk_bytes. Other processes may share the cache folder and remove files at
+    the same time, so files that have already disappeared are simply skipped.'''
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.pkl'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except FileNotFoundError:
+            pass
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= cache_disk_bytes:
+            break
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def read_disk_cache(path):
+    '''Loads a result from disk, or returns None if there is none (including when
+    another process removes the file while it is being looked up).'''
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    # Marks the file as recently used for eviction purposes
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return (result,)
+
+def write_disk_cache(path, result):
+    '''Saves a result to disk. Each writer uses its own temporary file, so two
+    processes calculating the same result do not write into the same file.'''
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    evict_disk_cache()
+
+def cached(func, fingerprint):
+    '''Wraps an aggregation function so that its results are looked up in memory, then
+    on disk, and only calculated if neither has them.'''
+    def wrapper(*args, **kwargs):
+        key = cache_key(fingerprint, func, args, kwargs)
+        if key in mem_cache:
+            mem_cache.move_to_end(key)
+            return mem_cache[key]
+
+        path = os.path.join(cache_dir, key + '.pkl')
+        found = read_disk_cache(path)
+        if found is not None:
+            result = found[0]
+        else:
+            result = func(*args, **kwargs)
+            write_disk_cache(path, result)
+
+        mem_cache[key] = result
+        if len(mem_cache) > cache_mem_items:
+            mem_cache.popitem(last=False)
+        return result
+    return wrapper
+
+# --- PARTIAL AGGREGATES ------------------------------
+'''Every monthly figure in the program proper is a count or an average, both of which
+can be calculated from counts and sums alone. Instead of concatenating every reduced
+file into one master dataset, each month can be reduced to a partial aggregate: for
+every month and every (sub)category, the number of trips, the sum and sum of squares of
+the trip durations, and a histogram of trip durations, along with the paths of the
+samples that went into it. Partial aggregates can be merged in any order and in any
+grouping, so separate processes (or machines sharing a folder) can each reduce some of
+the months, and merging their results gives the same figures as overall, by_gender
+and by_user.'''
+# Trip duration histogram bins: 5-minute bins up to the 5-hour cutoff in csv_redux
+hist_edges = np.arange(0, 305, 5)
+hist_cols = ['hist ' + str(e) for e in hist_edges[:-1]]
+partial_keys = ['group', 'value', 'year', 'month']
+stat_cols = ['count', 'sum', 'sumsq'] + hist_cols
+
+def partial_aggregate(sample, sample_path=None):
+    '''Reduces a sample from csv_redux (or any part of the master dataset) into a
+    partial aggregate.'''
+    td = sample['tripduration'].to_numpy(dtype=float)
+    trips = pd.DataFrame({'year': pd.to_numeric(sample['year']).astype(int).to_numpy(),
+                          'month': pd.to_numeric(sample['month']).astype(int).to_numpy(),
+                          'sum': td, 'sumsq': td ** 2,
+                          'bin': np.clip(np.digitize(td, hist_edges) - 1, 0, len(hist_cols) - 1)})
+    groups = {'overall': np.full(len(trips), 'all'),
+              'gender': sample['gender'].astype(int).astype(str).to_numpy(),
+              'usertype': sample['usertype'].astype(str).to_numpy()}
+    parts = []
+    for group, values in groups.items():
+        trips['value'] = values
+        by = trips.groupby(['value', 'year', 'month'])
+        stats_part = by[['sum', 'sumsq']].sum()
+        stats_part.insert(0, 'count', by.size())
+        hist = trips.groupby(['value', 'year', 'month', 'bin']).size().unstack(fill_value=0)
+        hist = hist.reindex(columns=range(len(hist_cols)), fill_value=0)
+        hist.columns = hist_cols
+        stats_part = stats_part.join(hist).astype(float)
+        stats_part.index = pd.MultiIndex.from_tuples([(group,) + k for k in stats_part.index], names=partial_keys)
+        parts.append(stats_part)
+    return {'stats': pd.concat(parts), 'samples': [sample_path] if sample_path else []}
+
+def merge_partials(partials):
+    '''Merges any number of partial aggregates into one. Since every column is a sum,
+    the order and grouping of the merges does not matter. Merging no partial aggregates
+    at all (for example, while the workers have not saved anything yet) gives an empty
+    one.'''
+    if not partials:
+        empty_keys = pd.MultiIndex.from_arrays([[], [], [], []], names=partial_keys)
+        return {'stats': pd.DataFrame(columns=stat_cols, index=empty_keys, dtype=float), 'samples': []}
+    stats_all = pd.concat([p['stats'] for p in partials]).groupby(level=partial_keys).sum()
+    samples = sorted(set(s for p in partials for s in p['samples']))
+    return {'stats': stats_all, 'samples': samples}
+
+def save_partial(partial, path):
+    '''Saves a partial aggregate as a plain numpy archive. The file is written under a
+    temporary name first, so other processes never see a half-written partial.'''
+    keys = partial['stats'].index
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, group=np.asarray(keys.get_level_values('group'), dtype=str),
+                 value=np.asarray(keys.get_level_values('value'), dtype=str),
+                 year=np.asarray(keys.get_level_values('year'), dtype=int),
+                 month=np.asarray(keys.get_level_values('month'), dtype=int),
+                 stats=partial['stats'].to_numpy(dtype=float),
+                 samples=np.asarray(partial['samples'], dtype=str))
+    os.replace(path + '.tmp', path)
+
+def load_partial(path):
+    '''Loads a partial aggregate saved with save_partial.'''
+    with np.load(path) as f:
+        keys = pd.MultiIndex.from_arrays([f['group'], f['value'], f['year'], f['month']], names=partial_keys)
+        stats_all = pd.DataFrame(f['stats'], index=keys, columns=stat_cols)
+        return {'stats': stats_all, 'samples': list(f['samples'])}
+
+def master_aggregates(partial, yrs):
+    '''Calculates the same monthly figures as overall, by_gender and by_user from a
+    partial aggregate, in the same order, so they can be used for the same plots.'''
+    stats_all = partial['stats']
+    categories = {'overall': ['all'], 'gender': ['0', '1', '2'], 'usertype': ['Customer', 'Subscriber']}
+    aggregates = {}
+    for group, values in categories.items():
+        freq_lists = []
+        avg_lists = []
+        for k in values:
+            for i in yrs:
+                for j in range(1, 13):
+                    key = (group, k, i, j)
+                    count = stats_all.at[key, 'count'] if key in stats_all.index else 0
+                    freq_lists.append(5 * int(count))
+                    avg_lists.append(stats_all.at[key, 'sum'] / count if count else np.nan)
+        # Splits each of the two lists by intervals of twelve for each year.
+        freq_splits = [freq_lists[x:x + 12] for x in range(0, len(freq_lists), 12)]
+        avg_splits = [avg_lists[x:x + 12] for x in range(0, len(avg_lists), 12)]
+        aggregates[group] = (freq_splits, avg_splits)
+    return aggregates
+
+def partial_name(datafile):
+    '''Names the outputs of a data file after the file itself (for example,
+    jan2019-citibike-tripdata).'''
+    return os.path.splitext(os.path.basename(datafile.replace('\\', '/')))[0]
+
+def partial_path(datafile, out_dir):
+    '''Where the partial aggregate of a data file is saved in the shared folder.'''
+    return os.path.join(out_dir, partial_name(datafile) + '.partial.npz')
+
+def reduce_worker(datafiles, out_dir, overwrite=False):
+    '''Reduces each of the given data files, saving the sample and its partial aggregate
+    in the shared folder. Files that already have a partial aggregate are skipped, so an
+    interrupted run can be picked up again, unless overwrite=True, in which case every
+    file is sampled again.'''
+    for datafile in datafiles:
+        name = partial_name(datafile)
+        if os.path.exists(partial_path(datafile, out_dir)) and not overwrite:
+            continue
+        sample = csv_redux(datafile)
+        sample_path = os.path.join(out_dir, name + '-sample.csv')
+        sample.to_csv(sample_path, index=False)
+        save_partial(partial_aggregate(sample, sample_path), partial_path(datafile, out_dir))
+
+def merge_dir(out_dir, datafiles=None):
+    '''Merges the partial aggregates of the given data files that are in the shared
+    folder so far (files the workers have not finished yet are left out). Without a
+    list of data files, every partial aggregate in the folder is merged, including
+    any left over from earlier runs.'''
+    if datafiles is None:
+        paths = sorted(glob.glob(os.path.join(out_dir, '*.partial.npz')))
+    else:
+        paths = [partial_path(f, out_dir) for f in datafiles]
+        paths = [p for p in paths if os.path.exists(p)]
+    return merge_partials([load_partial(p) for p in paths])
+
+def distributed_reduce(datafiles, out_dir, workers=4, overwrite=False):
+    '''Splits the data files between several worker processes on this machine, then
+    merges their partial aggregates. On several machines, each one would instead call
+    reduce_worker on its own share of the files, and merge_dir would be called once
+    they are all done.'''
+    os.makedirs(out_dir, exist_ok=True)
+    shares = [(datafiles[w::workers], out_dir, overwrite) for w in range(workers)]
+    # Each worker gets its own random seed, or forked workers would all take the same samples
+    with multiprocessing.Pool(workers, initializer=np.random.seed) as pool:
+        pool.starmap(reduce_worker, shares)
+    return merge_dir(out_dir, datafiles)
+
+# --- SQL STORE ------------------------------
+'''Answering a one-off question about the master dataset means loading all of
+masterdata.csv first, which takes minutes. The master dataset can instead be exported
+to a local SQLite database, with indexes on the columns that questions are usually
+asked about and views with the same monthly summaries as overall, by_gender and
+by_user. Queries then only read the rows they need.'''
+sql_db = os.path.join('output', 'masterdata.db')
+
+# Columns of the master dataset and their names in the database
+sql_cols = {'tripduration': 'tripduration', 'starttime': 'starttime',
+            'start station name': 'start_station', 'end station name': 'end_station',
+            'usertype': 'usertype', 'birth year': 'birth_year', 'gender': 'gender',
+            'year': 'year', 'month': 'month',
+            'start station latitude': 'start_lat', 'start station longitude': 'start_lon',
+            'end station latitude': 'end_lat', 'end station longitude': 'end_lon'}
+
+sql_schema = '''
+CREATE TABLE trips (
+    tripduration REAL, starttime TEXT, start_station TEXT, end_station TEXT,
+    usertype TEXT, birth_year INTEGER, gender INTEGER, year INTEGER, month INTEGER,
+    start_lat REAL, start_lon REAL, end_lat REAL, end_lon REAL
+);
+'''
+
+sql_indexes = '''
+CREATE INDEX idx_trips_year_month ON trips (year, month);
+CREATE INDEX idx_trips_usertype ON trips (usertype);
+CREATE INDEX idx_trips_gender ON trips (gender);
+CREATE INDEX idx_trips_start_station ON trips (start_station);
+CREATE INDEX idx_trips_end_station ON trips (end_station);
+'''
+
+# As with the other figures, the number of trips is multiplied by 5 to make up for the 20% sample.
+sql_views = '''
+CREATE VIEW monthly_overall AS
+    SELECT year, month, 5 * COUNT(*) AS trips, AVG(tripduration) AS avg_duration
+    FROM trips GROUP BY year, month;
+CREATE VIEW monthly_gender AS
+    SELECT gender, year, month, 5 * COUNT(*) AS trips, AVG(tripduration) AS avg_duration
+    FROM trips GROUP BY gender, year, month;
+CREATE VIEW monthly_usertype AS
+    SELECT usertype, year, month, 5 * COUNT(*) AS trips, AVG(tripduration) AS avg_duration
+    FROM trips GROUP BY usertype, year, month;
+'''
+
+def export_sqlite(data, db_path=sql_db, stations=None, chunksize=500000):
+    '''Exports the master dataset to a SQLite database, replacing any earlier export.
+    The master dataset can either be given as a dataframe or as the path to a csv file
+    (such as output/masterdata.csv), which is read in chunks so that it never has to be
+    loaded all at once. A station table (see STATION INDEX) can also be exported.'''
+    if isinstance(data, str):
+        chunks = pd.read_csv(data, chunksize=chunksize)
+    else:
+        chunks = [data]
+
+    '''The new database is built under a temporary name and only replaces the earlier
+    export once it is complete, so a failed export leaves the earlier one untouched.
+    Since the temporary file is thrown away if anything fails, it does not need a
+    journal.'''
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        con = sqlite3.connect(tmp_path)
+        try:
+            con.execute('PRAGMA journal_mode = OFF')
+            con.execute('PRAGMA synchronous = OFF')
+            con.executescript(sql_schema)
+            for chunk in chunks:
+                chunk = chunk[[c for c in sql_cols if c in chunk.columns]].rename(columns=sql_cols)
+                chunk['year'] = pd.to_numeric(chunk['year']).astype(int)
+                chunk['month'] = pd.to_numeric(chunk['month']).astype(int)
+                chunk.to_sql('trips', con, if_exists='append', index=False)
+            if stations is not None:
+                stations.rename(columns={'station name': 'station'}).to_sql('stations', con, index=False)
+
+            '''The indexes are only created once all the trips are in, which is much faster
+            than keeping them up to date while inserting.'''
+            con.executescript(sql_indexes)
+            con.executescript(sql_views)
+            con.execute('ANALYZE')
+            con.commit()
+        finally:
+            con.close()
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, db_path)
+
+def query_sqlite(sql, params=(), db_path=sql_db):
+    '''Runs a query on the exported database and returns the result as a dataframe.
+    For example:
+
+    query_sqlite('SELECT * FROM monthly_gender WHERE year = ?', (2020,))
+    query_sqlite('SELECT AVG(tripduration) FROM trips WHERE start_station = ? AND year = ? AND month = ?',
+                 ('W 21 St & 6 Ave', 2020, 4))'''
+    con = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+# --- QUERY DAEMON ------------------------------
+'''Every script that needs the master dataset has to load it again, which takes far
+longer than any one query. Instead, a daemon can load the master dataset once and keep
+it in memory, along with its partial aggregate (see PARTIAL AGGREGATES), and answer
+queries from other processes over a local socket. Each request and each response is
+one line of JSON. The daemon is started with:
+
+$ python source.py serve
+
+and queried with daemon_query (or daemon_aggregate, daemon_slice and daemon_predict).'''
+daemon_host = '127.0.0.1'
+daemon_port = 8765
+
+# Labels of the predictions, in the same order as in preds
+pred_labels = ["Overall Number of Trips", "Number of Trips by Riders of Other/Unknown Gender",
+               "Number of Trips by Male Riders", "Number of Trips by Female Riders",
+               "Number of Trips by Customers", "Number of Trips by Subscribers",
+               "Overall Average Trip Duration (min)", "Average Trip Duration of Riders of Other/Unknown Gender (min)",
+               "Average Trip Duration of Male Riders (min)", "Average Trip Duration of Female Riders (min)",
+               "Average Trip Duration of Customers (min)", "Average Trip Duration of Subscribers (min)"]
+
+def predictions(aggregates, month):
+    '''Fits the same full and partial 2020 regression models as the program proper to
+    the monthly figures from master_aggregates (for [2019, 2020]) and makes predictions
+    for the given month (0 to 11).'''
+    xmonths = 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11
+    xmn_part = xmonths[0:2] + xmonths[6:11]
+    series20 = []
+    for i in (0, 1):
+        for group in ('overall', 'gender', 'usertype'):
+            # Every other list is 2020 (the lists alternate 2019, 2020 for each category)
+            series20 += aggregates[group][i][1::2]
+    full2020 = []
+    part2020 = []
+    for s20 in series20:
+        full2020.append(np.poly1d(np.polyfit(xmonths[0:11], s20[0:11], 3))(month))
+        part2020.append(np.poly1d(np.polyfit(xmn_part, s20[0:2] + s20[6:11], 3))(month))
+    return {label: [full, part] for label, full, part in zip(pred_labels, full2020, part2020)}
+
+def load_daemon_data(data):
+    '''Loads the master dataset (from masterdata.csv or a dataframe) and calculates its
+    partial aggregate.'''
+    md = load_masterdata(data)
+    return md, partial_aggregate(md)
+
+def daemon_answer(md, partial, request):
+    '''Answers a single request. There are three kinds of queries:
+    aggregate: {"op": "aggregate", "group": "gender", "yrs": [2019, 2020]}
+        the monthly figures of overall, by_gender or by_user
+    slice: {"op": "slice", "filters": {"year": 2020, "usertype": "Customer"}, "limit": 10}
+        the number of trips and average trip duration of the matching trips, along with
+        the first few of them
+    predict: {"op": "predict", "month": 11}
+        the same predictions as preds'''
+    op = request.get('op')
+    if op == 'ping':
+        return 'pong'
+    if op == 'aggregate':
+        return master_aggregates(partial, request.get('yrs', [2019, 2020]))[request.get('group', 'overall')]
+    if op == 'slice':
+        mask = np.ones(len(md), dtype=bool)
+        for col, value in request.get('filters', {}).items():
+            mask &= (md[col] == value).to_numpy()
+        matched = md[mask]
+        return {'trips': 5 * len(matched), 'avg_duration': matched['tripduration'].mean(),
+                'rows': matched.head(request.get('limit', 0)).to_dict(orient='records')}
+    if op == 'predict':
+        return predictions(master_aggregates(partial, [2019, 2020]), request.get('month', 11))
+    raise ValueError('Unknown op: ' + str(op))
+
+def to_json(obj):
+    '''Converts a result into plain Python values that json can handle. Numpy values
+    become Python values, and NaN (for example, the average trip duration of an empty
+    slice) becomes None, since NaN is not valid JSON. Anything else raises an error
+    instead of being quietly turned into a string.'''
+    if isinstance(obj, dict):
+        return {k: to_json(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_json(v) for v in obj]
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    raise TypeError('Cannot convert ' + type(obj).__name__ + ' to JSON')
+
+async def daemon_main(md, partial, host, port):
+    '''Runs the request loop of the daemon until it receives a shutdown request.'''
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    connections = {}
+
+    async def handle(reader, writer):
+        '''Answers requests from one connection until it is closed. The queries run in a
+        thread pool so that a slow query does not hold up the other connections.'''
+        connections[asyncio.current_task()] = writer
+        shutdown = False
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if request.get('op') == 'shutdown':
+                        shutdown = True
+                        result = None
+                    else:
+                        result = await loop.run_in_executor(None, daemon_answer, md, partial, request)
+                    response = json.dumps({'ok': True, 'result': to_json(result)}, allow_nan=False)
+                except Exception as e:
+                    response = json.dumps({'ok': False, 'error': repr(e)})
+                writer.write((response + '\n').encode())
+                await writer.drain()
+                # Stops reading from this connection once the shutdown has been answered
+                if shutdown:
+                    break
+        except ConnectionError:
+            # The client went away in the middle of a request, which only ends its connection
+            pass
+        finally:
+            if shutdown:
+                stop.set()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            connections.pop(asyncio.current_task(), None)
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await stop.wait()
+        '''Closes any other connections that are still open, so that their handlers
+        finish on their own instead of being cancelled.'''
+        for writer in list(connections.values()):
+            writer.close()
+        await asyncio.gather(*connections, return_exceptions=True)
+
+def serve_daemon(data=os.path.join('output', 'masterdata.csv'), host=daemon_host, port=daemon_port):
+    '''Loads the master dataset once, then serves queries until a shutdown request.'''
+    md, partial = load_daemon_data(data)
+    print('Serving master dataset (' + str(len(md)) + ' trips) on ' + host + ':' + str(port))
+    asyncio.run(daemon_main(md, partial, host, port))
+
+def daemon_query(request, host=daemon_host, port=daemon_port, timeout=60):
+    '''Sends one request to the daemon and returns its result.'''
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall((json.dumps(request) + '\n').encode())
+        with conn.makefile('rb') as f:
+            response = json.loads(f.readline())
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+def daemon_aggregate(group='overall', yrs=None, **kwargs):
+    '''Asks the daemon for the monthly figures of 'overall', 'gender' or 'usertype'
+    (for 2019 and 2020, unless other years are given).'''
+    if yrs is None:
+        yrs = [2019, 2020]
+    return daemon_query({'op': 'aggregate', 'group': group, 'yrs': yrs}, **kwargs)
+
+def daemon_slice(filters, limit=0, **kwargs):
+    '''Asks the daemon about the trips matching the given column values.'''
+    return daemon_query({'op': 'slice', 'filters': filters, 'limit': limit}, **kwargs)
+
+def daemon_predict(month=11, **kwargs):
+    '''Asks the daemon for the predictions for the given month.'''
+    return daemon_query({'op': 'predict', 'month': month}, **kwargs)
+
 # --- PROGRAM PROPER -----------------------------------
-def program_proper():
+def program_proper(use_cache=True, pipelined=True, md=None, read_depth=None):
     # --- CSV Redux, Concatenation, and Extraction
     '''Because of the size of each original data file, it was better to run them through
     individually instead of all at once (hence the lack of a for loop in the csv_redux
@@ -88,34 +817,54 @@ def program_proper():
     stopping the entire process all at once.'''
     '''Due to the way Atom processed some of the file names, a z had to be added to the
     front of the file name to get around the issue.'''
-    jan19 = csv_redux('input\jan2019-citibike-tripdata.csv')
-    feb19 = csv_redux('input\zfeb2019-citibike-tripdata.csv')
-    mar19 = csv_redux('input\mar2019-citibike-tripdata.csv')
-    apr19 = csv_redux('input\zapr2019-citibike-tripdata.csv')
-    may19 = csv_redux('input\may2019-citibike-tripdata.csv')
-    jun19 = csv_redux('input\jun2019-citibike-tripdata.csv')
-    jul19 = csv_redux('input\jul2019-citibike-tripdata.csv')
-    aug19 = csv_redux('input\zaug2019-citibike-tripdata.csv')
-    sep19 = csv_redux('input\sep2019-citibike-tripdata.csv')
-    oct19 = csv_redux('input\oct2019-citibike-tripdata.csv')
-    nov19 = csv_redux('input\znov2019-citibike-tripdata.csv')
-    dec19 = csv_redux('input\dec2019-citibike-tripdata.csv')
-    jan20 = csv_redux('input\jan2019-citibike-tripdata.csv')
-    feb20 = csv_redux('input\zfeb2019-citibike-tripdata.csv')
-    mar20 = csv_redux('input\mar2019-citibike-tripdata.csv')
-    apr20 = csv_redux('input\zapr2019-citibike-tripdata.csv')
-    may20 = csv_redux('input\may2019-citibike-tripdata.csv')
-    jun20 = csv_redux('input\jun2019-citibike-tripdata.csv')
-    jul20 = csv_redux('input\jul2019-citibike-tripdata.csv')
-    aug20 = csv_redux('input\zaug2019-citibike-tripdata.csv')
-    sep20 = csv_redux('input\sep2019-citibike-tripdata.csv')
-    oct20 = csv_redux('input\oct2019-citibike-tripdata.csv')
-    nov20 = csv_redux('input\znov2019-citibike-tripdata.csv')
-    '''Once all the original datasets are reduced, they are all concatenated into a
-    new master dataset for use in the program proper.'''
-    md = pd.concat([jan19, feb19, mar19, apr19, may19, jun19, jul19, aug19, sep19,
-              oct19, nov19, dec19, jan20, feb20, mar20, apr20, may20, jun20,
-              jul20, aug20, sep20, oct20, nov20])
+    '''A master dataset from an earlier run (a dataframe, or the path to its csv file)
+    can be given as md, in which case the data files are not reduced again.'''
+    if md is not None:
+        md = load_masterdata(md)
+    else:
+        input_files = ['input\jan2019-citibike-tripdata.csv',
+                       'input\zfeb2019-citibike-tripdata.csv',
+                       'input\mar2019-citibike-tripdata.csv',
+                       'input\zapr2019-citibike-tripdata.csv',
+                       'input\may2019-citibike-tripdata.csv',
+                       'input\jun2019-citibike-tripdata.csv',
+                       'input\jul2019-citibike-tripdata.csv',
+                       'input\zaug2019-citibike-tripdata.csv',
+                       'input\sep2019-citibike-tripdata.csv',
+                       'input\oct2019-citibike-tripdata.csv',
+                       'input\znov2019-citibike-tripdata.csv',
+                       'input\dec2019-citibike-tripdata.csv',
+                       'input\jan2019-citibike-tripdata.csv',
+                       'input\zfeb2019-citibike-tripdata.csv',
+                       'input\mar2019-citibike-tripdata.csv',
+                       'input\zapr2019-citibike-tripdata.csv',
+                       'input\may2019-citibike-tripdata.csv',
+                       'input\jun2019-citibike-tripdata.csv',
+                       'input\jul2019-citibike-tripdata.csv',
+                       'input\zaug2019-citibike-tripdata.csv',
+                       'input\sep2019-citibike-tripdata.csv',
+                       'input\oct2019-citibike-tripdata.csv',
+                       'input\znov2019-citibike-tripdata.csv']
+        '''With pipelined=True (see READ-AHEAD PIPELINE above), the next file is read from
+        disk while the current one is being reduced. read_depth sets how many files can
+        be read ahead (by default, the module's read_depth).'''
+        if pipelined:
+            reduced = pipelined_redux(input_files, read_depth)
+        else:
+            reduced = (csv_redux(datafile) for datafile in input_files)
+        (jan19, feb19, mar19, apr19, may19, jun19, jul19, aug19,
+         sep19, oct19, nov19, dec19, jan20, feb20, mar20, apr20,
+         may20, jun20, jul20, aug20, sep20, oct20, nov20) = reduced
+        '''Once all the original datasets are reduced, they are all concatenated into a
+        new master dataset for use in the program proper.'''
+        md = pd.concat([jan19, feb19, mar19, apr19, may19, jun19, jul19, aug19, sep19,
+                  oct19, nov19, dec19, jan20, feb20, mar20, apr20, may20, jun20,
+                  jul20, aug20, sep20, oct20, nov20])
+
+    '''The fingerprint of the master dataset is what the cached results are checked
+    against (see RESULT CACHE above).'''
+    if use_cache:
+        md_fp = md_fingerprint(md)
 
     # --- Graphing/Plotting Labels ------------------------------
     # Label(s) for all figures
@@ -156,6 +905,9 @@ def program_proper():
         avg_splits = [avg_lists[x:x + 12] for x in range(0, len(avg_lists), 12)]
         return freq_splits, avg_splits
 
+    if use_cache:
+        overall = cached(overall, md_fp)
+
     ovr = overall([2019, 2020])
     ovr19cnt, ovr20cnt = ovr[0][:]
     ovr19avg, ovr20avg = ovr[1][:]
@@ -236,6 +988,9 @@ def program_proper():
         avg_splits = [avg_lists[x:x + 12] for x in range(0, len(avg_lists), 12)]
         return freq_splits, avg_splits
 
+    if use_cache:
+        by_gender = cached(by_gender, md_fp)
+
     gender = by_gender([2019, 2020])
     o19cnt, o20cnt, m19cnt, m20cnt, f19cnt, f20cnt = gender[0][:]
     o19avg, o20avg, m19avg, m20avg, f19avg, f20avg = gender[1][:]
@@ -370,6 +1125,9 @@ def program_proper():
         avg_splits = [avg_lists[x:x + 12] for x in range(0, len(avg_lists), 12)]
         return freq_splits, avg_splits
 
+    if use_cache:
+        by_user = cached(by_user, md_fp)
+
     user_stats = by_user([2019, 2020])
     cus19cnt, cus20cnt, sub19cnt, sub20cnt = user_stats[0][:]
     cus19avg, cus20avg, sub19avg, sub20avg = user_stats[1][:]
@@ -754,7 +1512,13 @@ def overlord():
     program_proper()
     print(preds(11))
 
-overlord()
+'''Only runs the whole program when this file is run directly, so that its functions
+can be imported (by test.py or by worker processes) without running everything.'''
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['serve']:
+        serve_daemon()
+    else:
+        overlord()
 
 # The original code from Colab with minor changes took around 3 minutes to run. 
 # The code as it is now with the suggested changes takes 10-12 minutes to run, with less consistency in execution.